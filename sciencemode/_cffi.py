@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
 from cffi import FFI
-from subprocess import check_output
+from subprocess import check_output, CalledProcessError, STDOUT
 import re
 import os
 import pycparser
 import json
+import hashlib
+import glob
+import tempfile
 import itertools
 import platform
 import sys
@@ -13,13 +16,14 @@ from pycparser import c_ast
 from pycparser.c_generator import CGenerator
 
 INCLUDE_PATTERN = re.compile(r'(-I)?(.*ScienceMode)')
-DEFINE_PATTERN = re.compile(r'^#define\s+(\w+)\s+\(?([\w<|.]+)\)?', re.M)
+DEFINE_PATTERN = re.compile(rb'^#define\s+(\w+)\s+\(?([\w<|.]+)\)?', re.M)
 DEFINE_BLACKLIST = {
     'main',
     }
 
 devel_root = os.path.abspath("./smpt/ScienceMode_Library")
 include_dir = os.path.join(devel_root, "include")
+include_dir_prefix = os.path.abspath(include_dir) + os.sep
 
 smpt_lib_path = os.path.abspath("./lib")
 
@@ -66,6 +70,28 @@ FUNCTION_BLACKLIST = {
 
 VARIADIC_ARG_PATTERN = re.compile(r'va_list \w+')
 ARRAY_SIZEOF_PATTERN = re.compile(r'\[[^\]]*sizeof[^\]]*]')
+LINE_MARKER_PATTERN = re.compile(r'^# \d+ "(.+?)"', re.M)
+
+# array lengths given by defines that end up as '...' in the cdef, substituted
+# in one pass, including the products of two of them
+ARRAY_LENGTHS = {
+    'Smpt_Length_Max_Packet_Size': 1200,
+    'Smpt_Length_Packet_Input_Buffer_Rows': 100,
+    'Smpt_Length_Serial_Port_Chars': 256,
+    'Smpt_Length_Number_Of_Acks': 100,
+    'Smpt_Length_Device_Id': 10,
+    'Smpt_Length_Points': 16,
+    'Smpt_Length_Number_Of_Channels': 8,
+}
+ARRAY_LENGTH_PATTERN = re.compile(r'\[({0})(?:\s*\*\s*({0}))?\]'.format(
+    '|'.join(map(re.escape, ARRAY_LENGTHS))))
+
+
+def array_length(match):
+    length = ARRAY_LENGTHS[match.group(1)]
+    if match.group(2):
+        length *= ARRAY_LENGTHS[match.group(2)]
+    return '[{}]'.format(length)
 
 HEADERS = [
     'general/smpt_client_data.h',
@@ -120,36 +146,76 @@ ROOT_HEADERS = [
     'mid-level/smpt_ml_client.h',
 ]
 
+ROOT_SOURCE = ('\n').join('#include "%s"' % header for header in ROOT_HEADERS)
+
+ROOT_HEADER_PATHS = [os.path.normpath(os.path.join(include_dir, header)) for header in ROOT_HEADERS]
+HEADER_PATHS = [os.path.normpath(os.path.join(include_dir, header)) for header in HEADERS]
 
 
-class Collector(c_ast.NodeVisitor):
+class Collector:
+
+    __slots__ = ('generator', 'typedecls', 'functions', '_coord_cache')
 
     def __init__(self):
         self.generator = CGenerator()
-        self.typedecls = []
-        self.functions = []
-
-    def process_typedecl(self, node):
-        coord = os.path.abspath(node.coord.file)
-        if node.coord is None or coord.find(include_dir) != -1:
-            typedecl = '{};'.format(self.generator.visit(node))
-            typedecl = ARRAY_SIZEOF_PATTERN.sub('[...]', typedecl)
-            if typedecl not in self.typedecls:
-                self.typedecls.append(typedecl)
+        # dicts are used as insertion ordered sets
+        self.typedecls = {}
+        self.functions = {}
+        self._coord_cache = {}
+
+    def _in_include(self, node):
+        filename = node.coord.file
+        try:
+            return self._coord_cache[filename]
+        except KeyError:
+            in_include = os.path.abspath(filename).startswith(include_dir_prefix)
+            self._coord_cache[filename] = in_include
+            return in_include
+
+    def visit(self, node):
+        # preorder walk with an explicit stack instead of NodeVisitor's
+        # recursion, children are pushed reversed to keep the original order.
+        # Nodes from the fake libc/windows headers never end up in the cdef,
+        # so their subtrees are skipped entirely.
+        handlers = self.HANDLERS
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            handler = handlers.get(node.__class__)
+            if handler is not None:
+                handler(self, node)
+            elif node.coord is None or self._in_include(node):
+                stack.extend(child for _, child in reversed(node.children()))
+
+    def process_typedecl(self, node, rendered=None):
+        if node.coord is None or self._in_include(node):
+            if rendered is None:
+                rendered = self.generator.visit(node)
+            typedecl = '{};'.format(rendered)
+            if 'sizeof' in typedecl:
+                typedecl = ARRAY_SIZEOF_PATTERN.sub('[...]', typedecl)
+            self.typedecls.setdefault(typedecl, None)
 
     def sanitize_enum(self, enum):
-        for name, enumeratorlist in enum.children():
-            for name, enumerator in enumeratorlist.children():
-                enumerator.value = c_ast.Constant('dummy', '...')
-        return enum
+        """Replace the enumerator values by '...' and return the enum rendered
+        the way CGenerator would, or None for an enum without a body."""
+        if enum.values is None:
+            return None
+        names = []
+        for enumerator in enum.values.enumerators:
+            enumerator.value = c_ast.Constant('dummy', '...')
+            names.append('  {} = ...'.format(enumerator.name))
+        return 'enum {}\n{{\n{}\n}}'.format(enum.name or '', ',\n'.join(names))
 
     def visit_Typedef(self, node):
-        coord = os.path.abspath(node.coord.file)
-        if node.coord is None or coord.find(include_dir) != -1:
+        if node.coord is None or self._in_include(node):
+            rendered = None
             if ((isinstance(node.type, c_ast.TypeDecl) and
                  isinstance(node.type.type, c_ast.Enum))):
-                self.sanitize_enum(node.type.type)
-            self.process_typedecl(node)
+                enum = self.sanitize_enum(node.type.type)
+                if enum is not None and not node.type.quals:
+                    rendered = 'typedef {} {}'.format(enum, node.type.declname)
+            self.process_typedecl(node, rendered)
 
     def visit_Union(self, node):
         self.process_typedecl(node)
@@ -158,14 +224,11 @@ class Collector(c_ast.NodeVisitor):
         self.process_typedecl(node)
 
     def visit_Enum(self, node):
-        coord = os.path.abspath(node.coord.file)
-        if node.coord is None or coord.find(include_dir) != -1:
-            node = self.sanitize_enum(node)
-            self.process_typedecl(node)
+        if node.coord is None or self._in_include(node):
+            self.process_typedecl(node, self.sanitize_enum(node))
 
     def visit_FuncDecl(self, node):
-        coord = os.path.abspath(node.coord.file)
-        if node.coord is None or coord.find(include_dir) != -1:
+        if node.coord is None or self._in_include(node):
             if isinstance(node.type, c_ast.PtrDecl):
                 function_name = node.type.type.declname
             else:
@@ -173,79 +236,232 @@ class Collector(c_ast.NodeVisitor):
             if function_name in FUNCTION_BLACKLIST:
                 return
             decl = '{};'.format(self.generator.visit(node))
-            decl = VARIADIC_ARG_PATTERN.sub('...', decl)
-            if decl not in self.functions:
-                self.functions.append(decl)
-
-
-ffi = FFI()
-
-
-
-
-ffi.set_source(
- "sciencemode._sciencemode",
- ('\n').join('#include "%s"' % header for header in ROOT_HEADERS),
- include_dirs = [include_dir, smpt_include_path1, smpt_include_path2, smpt_include_path3, smpt_include_path4],
- libraries = ['libsmpt'],
- library_dirs = ["./lib"],
-)
-
+            if 'va_list' in decl:
+                decl = VARIADIC_ARG_PATTERN.sub('...', decl)
+            self.functions.setdefault(decl, None)
+
+    HANDLERS = {
+        c_ast.Typedef: visit_Typedef,
+        c_ast.Union: visit_Union,
+        c_ast.Struct: visit_Struct,
+        c_ast.Enum: visit_Enum,
+        c_ast.FuncDecl: visit_FuncDecl,
+    }
 
 
-pycparser_args = {
-    'use_cpp': True,
-    'cpp_args': DEFINE_ARGS
-}
+cpp_path = 'cpp'
 if sys.platform.startswith('win'):  #windows
     mingw_path = os.getenv('MINGW_PATH', default='D:\\Qt\\Tools\\mingw530_32')
     # cl_path = "C:\\Program Files (x86)\\Microsoft Visual Studio\\2017\\Enterprise\\VC\\Tools\\MSVC\\14.16.27023\\bin\\Hostx86\\x64\\cl.exe"
-    pycparser_args['cpp_path'] = '{}\\bin\\cpp.exe'.format(mingw_path)
-
-collector = Collector()
-for header in ROOT_HEADERS:
-    ast = pycparser.parse_file(os.sep.join([include_dir, header]), **pycparser_args)
+    cpp_path = '{}\\bin\\cpp.exe'.format(mingw_path)
+
+
+def cpp_accepts(flag):
+    try:
+        check_output([cpp_path, flag, '-E', '-x', 'c', os.devnull], stderr=STDOUT)
+    except (OSError, CalledProcessError):
+        return False
+    return True
+
+# per user, a shared temp dir would let other local users supply the cdef
+CDEF_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+    'sciencemode')
+
+
+def cdef_cache_key():
+    """Hash of the inputs known before preprocessing: pycparser's version,
+    the preprocessor arguments, this build script and the stat info of the
+    listed SMPT headers. Everything else cpp pulls in (fake libc/windows
+    stubs, unlisted SMPT headers) is checked against the dependency list
+    stored with the cached cdef."""
+    digest = hashlib.sha1(pycparser.__version__.encode('utf-8'))
+    digest.update(repr([cpp_path] + DEFINE_ARGS).encode('utf-8'))
+    for path, mtime_ns, size in file_stats([__file__] + ROOT_HEADER_PATHS + HEADER_PATHS):
+        digest.update('{}:{}:{}\n'.format(path, mtime_ns, size).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def file_stats(paths):
+    """[path, mtime_ns, size] of every path that exists."""
+    stats = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        stats.append([path, stat.st_mtime_ns, stat.st_size])
+    return stats
+
+
+def generate_cdef():
+    cpp_args = [cpp_path] + DEFINE_ARGS
+    # GCC canonicalizes every system include directory with realpath, which
+    # costs a stat per path component and buys nothing for the SMPT tree,
+    # the flag doesn't change the output so it isn't part of the cache key
+    flag = '-fno-canonical-system-headers'
+    if cpp_accepts(flag):
+        cpp_args.append(flag)
+
+    # parse all root headers as one translation unit, the include guards of
+    # the SMPT headers keep the shared ones from being declared twice
+    fd, umbrella_path = tempfile.mkstemp(suffix='.h', dir=include_dir)
+    try:
+        with os.fdopen(fd, 'w') as umbrella_file:
+            umbrella_file.write(ROOT_SOURCE)
+        # run cpp ourselves and hand the translation unit straight to the parser
+        text = check_output(cpp_args + [umbrella_path], universal_newlines=True)
+    finally:
+        os.remove(umbrella_path)
+    ast = pycparser.CParser().parse(text, umbrella_path)
+
+    collector = Collector()
     collector.visit(ast)
 
-defines = set()
-for header_path in HEADERS:
-    with open(os.sep.join([include_dir, header_path]), 'r') as header_file:
-        header = header_file.read()
-        for match in DEFINE_PATTERN.finditer(header):
-            if match.group(1) in DEFINE_BLACKLIST or match.group(1) in collector.typedecls or match.group(1) in collector.functions:
-                continue
-            try:
-                int(match.group(2), 0)
-                defines.add('#define {} {}'.format(match.group(1),
-                                                   match.group(2)))
-            except:
-                defines.add('#define {} ...'.format(match.group(1)))
-
-print('Processing {} defines, {} types, {} functions'.format(
-    len(defines),
-    len(collector.typedecls),
-    len(collector.functions)
-))
-
-cdef = '\n'.join(itertools.chain(*[
-    defines,
-    collector.typedecls,
-    collector.functions
-]))
-
-cdef = cdef.replace('[Smpt_Length_Max_Packet_Size]', '[1200]')
-cdef = cdef.replace('[Smpt_Length_Packet_Input_Buffer_Rows]', '[100]')
-cdef = cdef.replace('[Smpt_Length_Packet_Input_Buffer_Rows * Smpt_Length_Max_Packet_Size]', '[120000]')
-cdef = cdef.replace('[Smpt_Length_Serial_Port_Chars]','[256]')
-cdef = cdef.replace('[Smpt_Length_Number_Of_Acks]', '[100]')
-cdef = cdef.replace('[Smpt_Length_Device_Id]', '[10]')
-cdef = cdef.replace('[Smpt_Length_Points]', '[16]')
-cdef = cdef.replace('[Smpt_Length_Number_Of_Channels]', '[8]')
-
-
-ffi.cdef(cdef)
-
-if False:
-    file = open('sciencemode.cdef', 'w')
-    file.write(cdef)
-    file.close()
+    # the line markers of cpp name every file of the translation unit, the
+    # cache entry depends on them. Defines come from all listed headers that
+    # exist, cpp runs with -D_WIN32 and its include closure is not the one of
+    # the set_source() compile on other platforms
+    included = {os.path.normcase(os.path.abspath(path))
+                for path in LINE_MARKER_PATTERN.findall(text)}
+    header_paths = [path for path in HEADER_PATHS if os.path.isfile(path)]
+
+    # headers are plain ASCII, read them as bytes and scan all of them in a
+    # single pass, only the matches get decoded
+    contents = []
+    for header_path in header_paths:
+        with open(header_path, 'rb') as header_file:
+            contents.append(header_file.read())
+
+    defines = set()
+    for match in DEFINE_PATTERN.finditer(b'\n'.join(contents)):
+        name = match.group(1).decode('ascii')
+        value = match.group(2).decode('ascii')
+        if name in DEFINE_BLACKLIST or name in collector.typedecls or name in collector.functions:
+            continue
+        try:
+            int(value, 0)
+            defines.add('#define {} {}'.format(name, value))
+        except:
+            defines.add('#define {} ...'.format(name))
+
+    print('Processing {} defines, {} types, {} functions'.format(
+        len(defines),
+        len(collector.typedecls),
+        len(collector.functions)
+    ))
+
+    # sorted, so that regenerating sciencemode.cdef gives a stable diff
+    cdef = '\n'.join(itertools.chain(*[
+        sorted(defines),
+        collector.typedecls,
+        collector.functions
+    ]))
+
+    return ARRAY_LENGTH_PATTERN.sub(array_length, cdef), sorted(included)
+
+
+def cached_cdef():
+    # the first line of a cache entry lists the stat info of every file of
+    # the translation unit, the entry is only used while all of them match
+    cdef_cache_path = os.path.join(CDEF_CACHE_DIR, 'cdef-{}.txt'.format(cdef_cache_key()))
+    try:
+        with open(cdef_cache_path, 'r') as cdef_file:
+            dependencies = json.loads(cdef_file.readline())
+            cdef = cdef_file.read()
+        if file_stats(path for path, _, _ in dependencies) == dependencies:
+            print('Using cached cdef {}'.format(cdef_cache_path))
+            return cdef
+    except (OSError, ValueError, TypeError):
+        pass  # missing, unreadable or malformed entry
+    cdef, included = generate_cdef()
+    try:
+        os.makedirs(CDEF_CACHE_DIR, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(cdef_cache_path, os.getpid())
+        with open(tmp_path, 'w') as cdef_file:
+            # the umbrella header and cpp's <built-in> entries don't exist
+            # and are skipped by file_stats
+            cdef_file.write(json.dumps(file_stats(included)) + '\n')
+            cdef_file.write(cdef)
+        os.replace(tmp_path, cdef_cache_path)
+        # entries of older headers are never hit again
+        for stale_path in glob.glob(os.path.join(CDEF_CACHE_DIR, 'cdef-*.txt')):
+            if stale_path != cdef_cache_path:
+                os.remove(stale_path)
+    except OSError:
+        pass  # the cache is only an optimization
+    return cdef
+
+
+# a cdef shipped next to this file (e.g. in an sdist) is used instead of
+# parsing the headers as long as it was generated from the same inputs, set
+# SCIENCEMODE_DUMP_CDEF=1 to regenerate it from the headers
+SHIPPED_CDEF_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sciencemode.cdef')
+SHIPPED_CDEF_KEY = '// sciencemode cdef key {}\n'
+
+
+def shipped_cdef_key():
+    """Content hash of pycparser's version, this build script and the listed
+    SMPT headers. Unlike cdef_cache_key() it doesn't depend on paths or
+    mtimes, so it stays valid in another checkout."""
+    digest = hashlib.sha1(pycparser.__version__.encode('utf-8'))
+    for name, path in zip(['_cffi.py'] + ROOT_HEADERS + HEADERS,
+                          [__file__] + ROOT_HEADER_PATHS + HEADER_PATHS):
+        with open(path, 'rb') as source_file:
+            digest.update(name.encode('utf-8'))
+            digest.update(source_file.read().replace(b'\r\n', b'\n'))
+    return digest.hexdigest()
+
+
+def shipped_cdef():
+    """The shipped cdef, or None if there is none or it doesn't belong to the
+    headers in include_dir. Without headers it is used as is."""
+    try:
+        with open(SHIPPED_CDEF_PATH, 'r') as cdef_file:
+            key = cdef_file.readline()
+            cdef = cdef_file.read()
+    except OSError:
+        return None
+    if os.path.isdir(include_dir):
+        try:
+            matches = key == SHIPPED_CDEF_KEY.format(shipped_cdef_key())
+        except OSError:
+            matches = False  # a listed header is missing, the key can't match
+    else:
+        matches = True
+    if not matches:
+        print('WARNING: {} was generated from other headers, ignoring it'.format(SHIPPED_CDEF_PATH))
+        return None
+    print('Using shipped cdef {}'.format(SHIPPED_CDEF_PATH))
+    return cdef
+
+
+def build_ffi():
+    """Create the FFI for sciencemode._sciencemode, called by cffi from
+    setup.py so that importing this module does no work."""
+    dump_cdef = bool(os.environ.get('SCIENCEMODE_DUMP_CDEF'))
+
+    cdef = None if dump_cdef else shipped_cdef()
+    if cdef is None:
+        cdef = cached_cdef()
+
+    ffi = FFI()
+    ffi.set_source(
+        "sciencemode._sciencemode",
+        ROOT_SOURCE,
+        include_dirs = [include_dir, smpt_include_path1, smpt_include_path2, smpt_include_path3, smpt_include_path4],
+        libraries = ['libsmpt'],
+        library_dirs = ["./lib"],
+    )
+    ffi.cdef(cdef)
+
+    if dump_cdef:
+        try:
+            key = shipped_cdef_key()
+        except OSError as error:
+            print('WARNING: not writing {}, {}'.format(SHIPPED_CDEF_PATH, error))
+        else:
+            with open(SHIPPED_CDEF_PATH, 'w') as cdef_file:
+                cdef_file.write(SHIPPED_CDEF_KEY.format(key))
+                cdef_file.write(cdef)
+    return ffi
@@ -2,5 +2,21 @@ from __future__ import absolute_import
 
 from sciencemode._sciencemode import lib, ffi
 
-for __name in dir(lib):
-    globals()[__name] = getattr(lib, __name)
\ No newline at end of file
+
+def __getattr__(name):
+    # resolve smpt functions and constants from lib on first use and keep
+    # them in the module globals, so later lookups are plain dict hits
+    if name == '__all__':
+        value = ['ffi', 'lib'] + [n for n in dir(lib) if not n.startswith('_')]
+        globals()[name] = value
+        return value
+    try:
+        value = getattr(lib, name)
+    except AttributeError:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name)) from None
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(dir(lib)))
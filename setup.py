@@ -12,7 +12,7 @@ import shutil
 VERSION = '1.0.0'
 
 package_data = {'': ['*.xml']}
-package_data['sciencemode'] = ['*.dll']
+package_data['sciencemode'] = ['*.dll', '*.cdef']
 #if sys.platform.startswith('win'):  # windows
 #    devel_roots = Path("./smpt/ScienceMode_Library").absolute()
 #    if platform.architecture()[0] == '64bit':
@@ -44,7 +44,7 @@ setup(
     ],
     setup_requires=['cffi>=1.0.0', 'pycparser>=2.14'],
     cffi_modules=[
-        '{}:ffi'.format(os.sep.join(['sciencemode', '_cffi.py'])),
+        'sciencemode/_cffi.py:build_ffi',
     ],
     install_requires=['cffi>=1.0.0']
 )
\ No newline at end of file